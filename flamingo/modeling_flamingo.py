@@ -4,6 +4,7 @@ from typing import Callable, Optional
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from accelerate.hooks import AlignDevicesHook, add_hook_to_module
 from einops import rearrange, repeat
 from transformers import CLIPVisionModel, LlamaForCausalLM, LlamaTokenizer
@@ -348,6 +349,7 @@ class FlamingoLayer(nn.Module):
         self.decoder_layer = decoder_layer
         self.vis_x = None
         self.media_locations = None
+        self.gradient_checkpointing = False
 
     def is_conditioned(self) -> bool:
         """Check whether the layer is conditioned."""
@@ -370,20 +372,38 @@ class FlamingoLayer(nn.Module):
         **decoder_layer_kwargs,
     ):
         if self.gated_cross_attn_layer is None:
-            return self.decoder_layer(lang_x, attention_mask=attention_mask, **decoder_layer_kwargs)
-
-        if self.vis_x is None:
-            raise ValueError("vis_x must be conditioned before forward pass")
-
-        if self.media_locations is None:
-            raise ValueError("media_locations must be conditioned before forward pass")
+            vis_x, media_locations, attend_previous = None, None, None
+        else:
+            if self.vis_x is None:
+                raise ValueError("vis_x must be conditioned before forward pass")
+
+            if self.media_locations is None:
+                raise ValueError("media_locations must be conditioned before forward pass")
+
+            vis_x, media_locations, attend_previous = self.vis_x, self.media_locations, self.attend_previous
+
+        if self.gradient_checkpointing and self.training:
+            # the conditioning is passed explicitly, since the layers are cleared before the recomputation in backward
+            return torch.utils.checkpoint.checkpoint(
+                self._forward,
+                lang_x,
+                attention_mask,
+                vis_x,
+                media_locations,
+                attend_previous,
+                use_reentrant=False,
+                **decoder_layer_kwargs,
+            )
+        return self._forward(lang_x, attention_mask, vis_x, media_locations, attend_previous, **decoder_layer_kwargs)
 
-        lang_x = self.gated_cross_attn_layer(
-            lang_x,
-            self.vis_x,
-            media_locations=self.media_locations,
-            attend_previous=self.attend_previous,
-        )
+    def _forward(self, lang_x, attention_mask, vis_x, media_locations, attend_previous, **decoder_layer_kwargs):
+        if self.gated_cross_attn_layer is not None:
+            lang_x = self.gated_cross_attn_layer(
+                lang_x,
+                vis_x,
+                media_locations=media_locations,
+                attend_previous=attend_previous,
+            )
         lang_x = self.decoder_layer(lang_x, attention_mask=attention_mask, **decoder_layer_kwargs)
         return lang_x
 
@@ -489,7 +509,7 @@ class FlamingoPreTrainedModel(PreTrainedModel):
         return super()._init_weights(module)
 
     def _set_gradient_checkpointing(self, module, value=False):
-        if isinstance(module, FlamingoModel):
+        if isinstance(module, (FlamingoModel, FlamingoLayer)):
             module.gradient_checkpointing = value
 
 
@@ -2,6 +2,7 @@ from typing import Optional, List
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from transformers.modeling_utils import PreTrainedModel
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from einops import rearrange, repeat
@@ -396,6 +397,7 @@ class OtterLayer(nn.Module):
         self.decoder_layer = decoder_layer
         self.vis_x = None
         self.media_locations = None
+        self.gradient_checkpointing = False
 
     def is_conditioned(self) -> bool:
         """Check whether the layer is conditioned."""
@@ -418,20 +420,38 @@ class OtterLayer(nn.Module):
         **decoder_layer_kwargs,
     ):
         if self.gated_cross_attn_layer is None:
-            return self.decoder_layer(lang_x, attention_mask=attention_mask, **decoder_layer_kwargs)
-
-        if self.vis_x is None:
-            raise ValueError("vis_x must be conditioned before forward pass")
-
-        if self.media_locations is None:
-            raise ValueError("media_locations must be conditioned before forward pass")
+            vis_x, media_locations, attend_previous = None, None, None
+        else:
+            if self.vis_x is None:
+                raise ValueError("vis_x must be conditioned before forward pass")
+
+            if self.media_locations is None:
+                raise ValueError("media_locations must be conditioned before forward pass")
+
+            vis_x, media_locations, attend_previous = self.vis_x, self.media_locations, self.attend_previous
+
+        if self.gradient_checkpointing and self.training:
+            # the conditioning is passed explicitly, since the layers are cleared before the recomputation in backward
+            return torch.utils.checkpoint.checkpoint(
+                self._forward,
+                lang_x,
+                attention_mask,
+                vis_x,
+                media_locations,
+                attend_previous,
+                use_reentrant=False,
+                **decoder_layer_kwargs,
+            )
+        return self._forward(lang_x, attention_mask, vis_x, media_locations, attend_previous, **decoder_layer_kwargs)
 
-        lang_x = self.gated_cross_attn_layer(
-            lang_x,
-            self.vis_x,
-            media_locations=self.media_locations,
-            attend_previous=self.attend_previous,
-        )
+    def _forward(self, lang_x, attention_mask, vis_x, media_locations, attend_previous, **decoder_layer_kwargs):
+        if self.gated_cross_attn_layer is not None:
+            lang_x = self.gated_cross_attn_layer(
+                lang_x,
+                vis_x,
+                media_locations=media_locations,
+                attend_previous=attend_previous,
+            )
         lang_x = self.decoder_layer(lang_x, attention_mask=attention_mask, **decoder_layer_kwargs)
         return lang_x
 
@@ -536,6 +556,10 @@ class OtterPreTrainedModel(PreTrainedModel):
         """Otter requires no specific initialization"""
         return super()._init_weights(module)
 
+    def _set_gradient_checkpointing(self, module, value=False):
+        if isinstance(module, OtterLayer):
+            module.gradient_checkpointing = value
+
 
 class OtterModel(OtterPreTrainedModel):
     config_class = OtterConfig
@@ -160,6 +160,11 @@ class MimicitDataset(Dataset):
         self.bos_mask = torch.LongTensor([1])
         self.eos_mask = torch.LongTensor([1])
 
+        self.media_token_id = args.media_token_id
+        self.endofchunk_token_id = args.endofchunk_token_id
+        self.answer_token_id = args.answer_token_id
+        self.image_dtype = getattr(args, "image_dtype", None)
+
     def random_init_case(self, question):
         if len(question) == 0:
             return question
@@ -659,11 +664,15 @@ class MimicitDataset(Dataset):
             samples_v1,
             pad_idx=self.tokenizer.pad_token_id,
             eos_idx=self.tokenizer.eos_token_id,
+            media_idx=self.media_token_id,
+            endofchunk_idx=self.endofchunk_token_id,
+            answer_idx=self.answer_token_id,
+            image_dtype=self.image_dtype,
         )
         return res_v1
 
 
-def collate_fn(samples, pad_idx, eos_idx):
+def collate_fn(samples, pad_idx, eos_idx, media_idx, endofchunk_idx, answer_idx, image_dtype=None):
     if len(samples) == 0:
         return {}
 
@@ -681,6 +690,7 @@ def collate_fn(samples, pad_idx, eos_idx):
     id = np.array([s["id"] for s in samples])
     src_tokens = merge("source", pad_idx=pad_idx, pading_size=larger_size)
     src_tokens_masks = merge("text_mask", pad_idx=0, pading_size=larger_size)
+    labels = collate_labels(src_tokens, pad_idx, media_idx, endofchunk_idx, answer_idx)
 
     batch = {
         "id": id,
@@ -688,6 +698,7 @@ def collate_fn(samples, pad_idx, eos_idx):
         "net_input": {
             "input_ids": src_tokens,
             "attention_masks": src_tokens_masks,
+            "labels": labels,
         },
     }
     # import pdb;pdb.set_trace()
@@ -695,10 +706,41 @@ def collate_fn(samples, pad_idx, eos_idx):
     # import pdb;pdb.set_trace()
     if samples[0].get("patch_images", None) is not None:
         batch["net_input"]["patch_images"] = torch.stack([sample["patch_images"] for sample in samples], dim=0)
+        if image_dtype is not None:
+            batch["net_input"]["patch_images"] = batch["net_input"]["patch_images"].to(image_dtype)
 
     return batch
 
 
+def chunk_prompt_mask(is_open, is_endofchunk):
+    """Mark the positions of a 2d batch that lie before the first opening token, or between an <|endofchunk|> and the next
+    opening token. The opening token is <answer> for MIMIC-IT and <image> for MMC4."""
+    # at every position, compare the index of the last opening token seen so far with the index of the last <|endofchunk|>
+    # strictly before it (-1 when there is none), this covers every row and chunk of the batch at once
+    token_idxs = torch.arange(is_open.shape[1], device=is_open.device).expand_as(is_open)
+    no_idxs = torch.full_like(token_idxs, -1)
+    last_open_idxs = torch.where(is_open, token_idxs, no_idxs).cummax(dim=1).values
+    last_endofchunk_idxs = torch.where(is_endofchunk, token_idxs, no_idxs).cummax(dim=1).values
+    last_endofchunk_idxs = torch.cat([no_idxs[:, :1], last_endofchunk_idxs[:, :-1]], dim=1)
+    return (last_open_idxs < 0) | (last_endofchunk_idxs > last_open_idxs)
+
+
+def collate_labels(src_tokens, pad_idx, media_idx, endofchunk_idx, answer_idx):
+    """Build the language modeling labels of a padded 2d batch of token ids, with -100 on every ignored position."""
+    # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
+    # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|><image>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
+    is_answer = src_tokens == answer_idx
+    is_endofchunk = src_tokens == endofchunk_idx
+    # the first token is always ignored, so it can neither open an answer nor close a chunk
+    is_answer[:, 0] = False
+    is_endofchunk[:, 0] = False
+
+    # every ignored position (prompts, padding, the first token, <answer> and <image>) is written in a single pass
+    ignored = chunk_prompt_mask(is_answer, is_endofchunk) | is_answer | (src_tokens == media_idx) | (src_tokens == pad_idx)
+    ignored[:, 0] = True
+    return src_tokens.masked_fill(ignored, -100)
+
+
 def collate_tokens(
     values,
     pad_idx,
@@ -824,6 +866,9 @@ if __name__ == "__main__":
         tokenizer.add_special_tokens({"pad_token": "<PAD>"})
 
         args.tokenizer = tokenizer
+        args.media_token_id = tokenizer("<image>", add_special_tokens=False)["input_ids"][-1]
+        args.endofchunk_token_id = tokenizer("<|endofchunk|>", add_special_tokens=False)["input_ids"][-1]
+        args.answer_token_id = tokenizer("<answer>", add_special_tokens=False)["input_ids"][-1]
 
         # test_dataset = MimicitDataset(args, mimicit_text_path, status_list=it_status)
 
@@ -729,6 +729,8 @@ def get_mimicit_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
     num_samples = num_batches * global_batch_size  # 8
 
     dataloaders = []
+    # let every worker stage a few batches ahead in pinned memory, kept small since each prefetched batch pins host memory
+    prefetch_kwargs = {"prefetch_factor": 4} if args.workers > 0 else {}
 
     # unified_datasets = unified_old_datasets + unified_new_datasets
 
@@ -744,6 +746,7 @@ def get_mimicit_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
             pin_memory=True,
             drop_last=True,
             collate_fn=unified_dataset.collate,
+            **prefetch_kwargs,
         )
 
         dataloaders.append(dataloader)
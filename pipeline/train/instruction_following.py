@@ -1,13 +1,16 @@
 """ Main training script """
 
 import argparse
+import contextlib
 import glob
 import os
 import random
+import re
 import time
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn
 from accelerate import Accelerator
 from tqdm import tqdm
@@ -24,7 +27,7 @@ from flamingo.modeling_flamingo import FlamingoForConditionalGeneration
 from otter.modeling_otter import OtterForConditionalGeneration
 from pipeline.train.data import get_data
 from pipeline.train.distributed import world_info_from_env
-from pipeline.train.train_utils import AverageMeter, get_checkpoint
+from pipeline.train.train_utils import AsyncScalar, AverageMeter, MultiPrefetcher, get_cast_dtype, get_checkpoint, unwrap_compiled_model
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -35,6 +38,9 @@ torch.backends.cuda.matmul.allow_tf32 = True
 # The flag below controls whether to allow TF32 on cuDNN. This flag defaults to True.
 torch.backends.cudnn.allow_tf32 = True
 
+# weight decay only applies to the gated cross attention weights, excluding their gates, norms and biases
+DECAY_PARAM_PATTERN = re.compile(r"^(?=.*gated_cross_attn_layer)(?!.*(?:ff_gate|attn_gate|norm|bias))")
+
 
 def random_seed(seed=42, rank=0):
     torch.manual_seed(seed + rank)
@@ -42,14 +48,10 @@ def random_seed(seed=42, rank=0):
     random.seed(seed + rank)
 
 
-def train_one_epoch(args, model, epoch, mimicit_loaders, tokenizer, optimizer, lr_scheduler, device_id, accelerator, wandb):
+def train_one_epoch(args, model, epoch, mimicit_loaders, optimizer, lr_scheduler, grad_masks, device_id, accelerator, wandb):
     num_batches_per_epoch = len(mimicit_loaders[0])
     total_training_steps = num_batches_per_epoch * args.num_epochs
 
-    media_token_id = tokenizer("<image>", add_special_tokens=False)["input_ids"][-1]
-    endofchunk_token_id = tokenizer("<|endofchunk|>", add_special_tokens=False)["input_ids"][-1]
-    answer_token_id = tokenizer("<answer>", add_special_tokens=False)["input_ids"][-1]
-
     model.train()
 
     # setup logging
@@ -58,136 +60,131 @@ def train_one_epoch(args, model, epoch, mimicit_loaders, tokenizer, optimizer, l
     end = time.time()
     dtype = model.dtype
     print(f"Using dtype {dtype}")
+    backward_on_device = accelerator.mixed_precision == "fp16"
+
+    # losses stay on device and are copied to pinned host memory without blocking, they are only read on the following step
+    # so that logging never waits for the step that produced them
+    loss_accum = torch.zeros(args.logging_steps, device=device_id)
+    wandb_loss, wandb_step_time, console_loss = AsyncScalar(), AsyncScalar(), AsyncScalar()
+    pending_logs = {}
+    pending_reduce = None
+
+    def resolve_pending_reduce():
+        nonlocal pending_reduce
+        if pending_reduce is None:
+            return
+        work, step_stats = pending_reduce
+        pending_reduce = None
+        if work is not None:
+            work.wait()
+        wandb_loss.copy_(step_stats[0])
+        wandb_step_time.copy_(step_stats[1])
+
+    def flush_pending_logs():
+        if "wandb" in pending_logs:
+            wandb_log = pending_logs.pop("wandb")
+            step_time = wandb_step_time.item()
+            wandb_log["loss_mimicit"] = wandb_loss.item()
+            wandb_log["mimicit_samples_per_second"] = args.gradient_accumulation_steps * args.batch_size * args.world_size / step_time
+            wandb_log["mimicit_samples_per_second_per_gpu"] = args.gradient_accumulation_steps * args.batch_size / step_time
+            wandb.log(wandb_log, commit=True)
+        if "console" in pending_logs:
+            console_step = pending_logs.pop("console")
+            print(f"Step {console_step}/{num_batches_per_epoch} of epoch {epoch+1}/{args.num_epochs} complete. Loss MIMIC-IT: {console_loss.item():.3f}")
 
     # loop through dataloader
     for num_steps, (batch_mimicits) in tqdm(
-        enumerate(zip(*mimicit_loaders)),
+        enumerate(MultiPrefetcher(mimicit_loaders, device_id)),
         disable=args.rank != 0,
         total=total_training_steps,
         initial=(epoch * num_batches_per_epoch),
     ):
         data_time_m.update(time.time() - end)
+        resolve_pending_reduce()
 
         global_step = num_steps + epoch * num_batches_per_epoch
         #### MIMIC-IT FORWARD PASS ####
-        total_losses = []
-        for batch_mimicit in batch_mimicits:
-            images = batch_mimicit["net_input"]["patch_images"].to(device_id, non_blocking=True)
-            input_ids = batch_mimicit["net_input"]["input_ids"].to(device_id, non_blocking=True)
-            attention_mask = batch_mimicit["net_input"]["attention_masks"].to(device_id, non_blocking=True)
-
-            labels = input_ids.clone()
-            labels[labels == tokenizer.pad_token_id] = -100
-            labels[:, 0] = -100
-
-            for i in range(labels.shape[0]):
-                # remove loss for any token before the first <image> token
-                # label_idx = 0
-                # while label_idx < labels.shape[1] and labels[i][label_idx] != media_token_id:
-                #     labels[i][label_idx] = -100
-                #     label_idx += 1
-
-                # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
-                # <image>User: {cur_incontext_instruction} GPT:<answer> {cur_incontext_answer}<|endofchunk|><image>User: {instruction} GPT:<answer> {answer}<|endofchunk|>
-
-                # get index of all endofchunk/media tokens in the sequence
-                endofchunk_idxs = torch.where(labels[i] == endofchunk_token_id)[0]
-                media_idxs = torch.where(labels[i] == media_token_id)[0]
-
-                # remove loss for any token the before the first <answer>
-                token_idx = 0
-                while token_idx < labels.shape[1] and labels[i][token_idx] != answer_token_id:
-                    labels[i][token_idx] = -100
-                    token_idx += 1
-
-                # remove loss for any token between <|endofchunk|> and <answer>, except <image>
-                for endofchunk_idx in endofchunk_idxs:
-                    token_idx = endofchunk_idx + 1
-                    while token_idx < labels.shape[1] and labels[i][token_idx] != answer_token_id:
-                        if labels[i][token_idx] == media_token_id:
-                            pass
-                        else:
-                            labels[i][token_idx] = -100
-                        token_idx += 1
-
-            labels[labels == answer_token_id] = -100
-            labels[labels == media_token_id] = -100
-
-            with accelerator.autocast():
-                loss_mimicit = model(
-                    vision_x=images.to(dtype),
-                    lang_x=input_ids,
-                    attention_mask=attention_mask,
-                    labels=labels,
-                )[0]
-            if accelerator.mixed_precision == "fp16":
-                accelerator.backward(loss_mimicit.to(device_id))
-            else:
-                accelerator.backward(loss_mimicit)
-
-            total_losses.append(loss_mimicit)
+        loss_sum = torch.zeros((), device=device_id)
+        n_micro = 0
+        with accelerator.accumulate(model):
+            for micro_idx, batch_mimicit in enumerate(batch_mimicits):
+                images = batch_mimicit["net_input"]["patch_images"]
+                input_ids = batch_mimicit["net_input"]["input_ids"]
+                attention_mask = batch_mimicit["net_input"]["attention_masks"]
+                labels = batch_mimicit["net_input"]["labels"]
+                # lay the images out as NHWC so the (b T F) c h w view the vision encoder receives is channels_last
+                images = images.permute(0, 1, 2, 4, 5, 3).contiguous().permute(0, 1, 2, 5, 3, 4)
+
+                # only the last backward of an optimizer step needs to all-reduce, earlier ones accumulate gradients locally.
+                # deepspeed handles gradient reduction inside its engine, so it is left alone.
+                if micro_idx + 1 < len(batch_mimicits) and accelerator.distributed_type != "DEEPSPEED":
+                    sync_context = accelerator.no_sync(model)
+                else:
+                    sync_context = contextlib.nullcontext()
+
+                with sync_context:
+                    with accelerator.autocast():
+                        loss_mimicit = model(
+                            vision_x=images,
+                            lang_x=input_ids,
+                            attention_mask=attention_mask,
+                            labels=labels,
+                        )[0]
+                    if backward_on_device:
+                        accelerator.backward(loss_mimicit.to(device_id))
+                    else:
+                        accelerator.backward(loss_mimicit)
+
+                loss_sum += loss_mimicit.detach().to(device_id)
+                n_micro += 1
         #### BACKWARD PASS ####
-        total_loss_sum = sum(total_losses)
-        mean_loss = total_loss_sum / len(total_losses)
-        # accelerator.backward(total_loss_sum.to(device_id))
+        mean_loss = loss_sum / n_micro
 
-        def mask_embedding(m):
-            if m.weight.requires_grad:
-                zero_mask = torch.zeros_like(m.weight.grad)
-                zero_mask[answer_token_id] = torch.ones_like(zero_mask[answer_token_id])
-                # zero_mask[media_token_id] = torch.ones_like(zero_mask[media_token_id])
-                # zero_mask[endofchunk_token_id] = torch.ones_like(zero_mask[endofchunk_token_id])
-                m.weight.grad = m.weight.grad * zero_mask
-
-        if args.mask_lm_head:
-            unwrapped_model = accelerator.unwrap_model(model)
-            if unwrapped_model.lang_encoder.__class__.__name__ in ["MPTForCausalLM", "MosaicGPT"]:
-                unwrapped_model.lang_encoder.transformer.wte.apply(mask_embedding)
-            elif unwrapped_model.lang_encoder.__class__.__name__ == "LlamaForCausalLM":
-                unwrapped_model.lang_encoder.model.embed_tokens.apply(mask_embedding)
-                unwrapped_model.lang_encoder.lm_head.apply(mask_embedding)
+        for weight, grad_mask in grad_masks:
+            if weight.grad is not None:
+                weight.grad.mul_(grad_mask)
 
         if accelerator.sync_gradients:
             accelerator.clip_grad_norm_(model.parameters(), 1.0)
 
         optimizer.step()
         lr_scheduler.step()
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
 
         # step time and reset end outside of rank 0
         step_time_m.update(time.time() - end)
         end = time.time()
 
+        loss_accum[num_steps % args.logging_steps] = mean_loss.detach()
+        flush_pending_logs()
+
         if accelerator.sync_gradients:
+            # loss and step time are averaged over all ranks with one async all-reduce. it is only waited on at the start of
+            # the next step, so the reduction overlaps with fetching the next batch and the values are logged one step later
+            step_stats = torch.stack([mean_loss.float(), torch.full((), step_time_m.val, device=device_id)])
+            if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+                step_stats /= dist.get_world_size()
+                pending_reduce = (dist.all_reduce(step_stats, async_op=True), step_stats)
+            else:
+                pending_reduce = (None, step_stats)
+
             if args.rank == 0 and args.report_to_wandb:
-                # compute within rank 0
-                mimicit_samples_per_second = args.gradient_accumulation_steps * args.batch_size * args.world_size / step_time_m.val
-                mimicit_samples_per_second_per_gpu = args.gradient_accumulation_steps * args.batch_size / step_time_m.val
-
-                wandb.log(
-                    {
-                        "data_time": data_time_m.avg,
-                        "step_time": step_time_m.avg,
-                        "mimicit_samples_per_second": mimicit_samples_per_second,
-                        "mimicit_samples_per_second_per_gpu": mimicit_samples_per_second_per_gpu,
-                        "lr": optimizer.param_groups[0]["lr"],
-                    },
-                    commit=False,
-                )
+                pending_logs["wandb"] = {
+                    "data_time": data_time_m.avg,
+                    "step_time": step_time_m.avg,
+                    "lr": optimizer.param_groups[0]["lr"],
+                    "global_step": global_step // args.gradient_accumulation_steps,
+                }
                 step_time_m.reset()
                 data_time_m.reset()
 
-                wandb.log(
-                    {
-                        "loss_mimicit": mean_loss.item(),
-                        "global_step": global_step // args.gradient_accumulation_steps,
-                    },
-                    commit=True,
-                )
-
         # Log loss to console
         if ((num_steps + 1) % args.logging_steps == 0) and args.rank == 0:
-            print(f"Step {num_steps+1}/{num_batches_per_epoch} of epoch {epoch+1}/{args.num_epochs} complete. Loss MIMIC-IT: {mean_loss.item():.3f}")
+            console_loss.copy_(loss_accum.mean())
+            pending_logs["console"] = num_steps + 1
+
+    resolve_pending_reduce()
+    flush_pending_logs()
 
 
 def parse_args():
@@ -373,6 +370,13 @@ def parse_args():
     parser.add_argument("--warmup_steps", default=1000, type=int)
     parser.add_argument("--warmup_steps_ratio", default=None, type=float)
     parser.add_argument("--weight_decay", default=0.1, type=float)
+    parser.add_argument(
+        "--optim",
+        default="adamw_fused",
+        type=str,
+        choices=["adamw", "adamw_fused", "adamw8bit"],
+        help="adamw, adamw_fused (fused CUDA kernel, plain adamw if trainable weights are not on the GPU) or adamw8bit (bitsandbytes 8-bit states)",
+    )
     parser.add_argument("--workers", type=int, default=4)
     # distributed training args
     parser.add_argument(
@@ -409,6 +413,18 @@ def parse_args():
         help="the maximum target sequence length",
     )
     parser.add_argument("--patch-image-size", type=int, default=224)
+    parser.add_argument(
+        "--gradient_checkpointing",
+        default=False,
+        action="store_true",
+        help="recompute the activations of the language decoder layers in backward to cut activation memory",
+    )
+    parser.add_argument(
+        "--compile_model",
+        default=False,
+        action="store_true",
+        help="wrap the model with torch.compile before accelerator.prepare to fuse kernels in the training step",
+    )
     # this could potentially save 33GB of all model parameters for otter-9b, including the language and vision model.
     parser.add_argument("--save_hf_model", default=False, action="store_true")
     # wandb args
@@ -515,26 +531,39 @@ def main():
     if "LlamaForCausalLM" in model.lang_encoder.__class__.__name__:
         model.lang_encoder.resize_token_embeddings(len(model.text_tokenizer))
 
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+
+    # match the channels_last images fed in train_one_epoch so the vision encoder's convolutions use NHWC kernels
+    model.vision_encoder.to(memory_format=torch.channels_last)
+
     args.tokenizer = model.text_tokenizer
     tokenizer = model.text_tokenizer
+    # sentinel token ids are resolved once here, both the collator and the training loop read them from args
+    args.media_token_id = tokenizer("<image>", add_special_tokens=False)["input_ids"][-1]
+    args.endofchunk_token_id = tokenizer("<|endofchunk|>", add_special_tokens=False)["input_ids"][-1]
+    args.answer_token_id = tokenizer("<answer>", add_special_tokens=False)["input_ids"][-1]
     random_seed(args.seed, args.rank)
 
     print(f"Start running training on rank {args.rank}.")
 
     # device_id = args.rank % torch.cuda.device_count()
 
+    # the collator emits images in the dtype the vision encoder consumes, so under mixed precision the upload carries half the bytes
+    if model.dtype in [torch.float16, torch.bfloat16]:
+        args.image_dtype = model.dtype
+    else:
+        args.image_dtype = get_cast_dtype(accelerator.mixed_precision)
+
     image_processor = CLIPImageProcessor()
     mimicit_loaders = get_data(args, image_processor, tokenizer, "mimicit")
 
     def get_grouped_params(model):
         params_with_wd, params_without_wd = [], []
 
-        def apply_decay(x):
-            return "gated_cross_attn_layer" in x and "ff_gate" not in x and "attn_gate" not in x and "norm" not in x and "bias" not in x
-
         for n, p in model.named_parameters():
             # if p.requires_grad:
-            if apply_decay(n):
+            if DECAY_PARAM_PATTERN.match(n):
                 params_with_wd.append(p)
             else:
                 params_without_wd.append(p)
@@ -565,7 +594,17 @@ def main():
         lr_scheduler.load_state_dict(checkpoint["lr_scheduler_state_dict"])
         resume_from_epoch = checkpoint["epoch"] + 1
 
-    optimizer = torch.optim.AdamW(get_grouped_params(model), lr=args.learning_rate)
+    if args.optim == "adamw8bit":
+        if accelerator.distributed_type == "DEEPSPEED":
+            raise ValueError("adamw8bit is not supported with deepspeed, use adamw or adamw_fused instead")
+        import bitsandbytes as bnb
+
+        optimizer = bnb.optim.AdamW8bit(get_grouped_params(model), lr=args.learning_rate, betas=(0.9, 0.999))
+    else:
+        # deepspeed steps (and may offload) the optimizer on its own, so it keeps the unfused implementation. the optimizer is
+        # built before accelerator.prepare, so the model can still be (partly) on the cpu here, which the fused kernel rejects
+        fused = args.optim == "adamw_fused" and accelerator.distributed_type != "DEEPSPEED" and all(p.is_cuda for p in model.parameters() if p.requires_grad)
+        optimizer = torch.optim.AdamW(get_grouped_params(model), lr=args.learning_rate, betas=(0.9, 0.999), fused=fused)
 
     if args.rank == 0:
         print(f"Total training steps: {total_training_steps}")
@@ -601,9 +640,33 @@ def main():
             config=vars(args),
         )
 
-    model, optimizer, lr_scheduler, mimicit_loaders = accelerator.prepare(model, optimizer, lr_scheduler, mimicit_loaders)
+    # compile before prepare so that DDP / DeepSpeed wraps the compiled module, dynamic shapes cover the variable mimicit sequence lengths.
+    # accelerator.unwrap_model keeps the compile wrapper, whose state_dict keys carry an "_orig_mod." prefix, so everything that
+    # saves or inspects the model goes through unwrap_compiled_model as well
+    if args.compile_model:
+        model = torch.compile(model, mode="default", dynamic=True, fullgraph=False)
+
+    # the mimicit loaders are left unprepared: data.py already shards them per rank, and their pinned batches are uploaded
+    # ahead of time on a side stream by MultiPrefetcher
+    model, optimizer, lr_scheduler = accelerator.prepare(model, optimizer, lr_scheduler)
     model.train()
 
+    # gradient masks for the embeddings only keep the <answer> row, they are built once here and applied in place every step
+    grad_masks = []
+    if args.mask_lm_head:
+        unwrapped_model = unwrap_compiled_model(accelerator.unwrap_model(model))
+        if unwrapped_model.lang_encoder.__class__.__name__ in ["MPTForCausalLM", "MosaicGPT"]:
+            masked_modules = [unwrapped_model.lang_encoder.transformer.wte]
+        elif unwrapped_model.lang_encoder.__class__.__name__ == "LlamaForCausalLM":
+            masked_modules = [unwrapped_model.lang_encoder.model.embed_tokens, unwrapped_model.lang_encoder.lm_head]
+        else:
+            masked_modules = []
+        for m in masked_modules:
+            if m.weight.requires_grad:
+                grad_mask = torch.zeros(m.weight.shape[0], 1, dtype=m.weight.dtype, device=m.weight.device)
+                grad_mask[args.answer_token_id] = 1
+                grad_masks.append((m.weight, grad_mask))
+
     for epoch in range(resume_from_epoch, args.num_epochs):
         for cur_data_loader in mimicit_loaders:
             cur_data_loader.dataset.set_epoch(epoch)
@@ -612,9 +675,9 @@ def main():
             args=args,
             model=model,
             epoch=epoch,
-            tokenizer=tokenizer,
             optimizer=optimizer,
             lr_scheduler=lr_scheduler,
+            grad_masks=grad_masks,
             mimicit_loaders=mimicit_loaders,
             accelerator=accelerator,
             device_id=device_id,
@@ -626,7 +689,7 @@ def main():
             if not os.path.exists(args.external_save_dir):
                 os.makedirs(args.external_save_dir)
 
-            unwrapped_model = accelerator.unwrap_model(model)
+            unwrapped_model = unwrap_compiled_model(accelerator.unwrap_model(model))
             checkpoint_dict = {
                 "epoch": epoch,
                 "model_state_dict": get_checkpoint(unwrapped_model),
@@ -648,7 +711,7 @@ def main():
         if not os.path.exists(args.external_save_dir):
             os.makedirs(args.external_save_dir)
 
-        unwrapped_model = accelerator.unwrap_model(model)
+        unwrapped_model = unwrap_compiled_model(accelerator.unwrap_model(model))
         accelerator.save(
             get_checkpoint(model=unwrapped_model),
             f"{args.external_save_dir}/final_weights.pt",
@@ -303,6 +303,9 @@ def main():
         model = FlamingoForConditionalGeneration(config=config)
 
     tokenizer = model.text_tokenizer
+    args.media_token_id = tokenizer("<image>", add_special_tokens=False)["input_ids"][-1]
+    args.endofchunk_token_id = tokenizer("<|endofchunk|>", add_special_tokens=False)["input_ids"][-1]
+    args.answer_token_id = tokenizer("<answer>", add_special_tokens=False)["input_ids"][-1]
     image_processor = CLIPImageProcessor()
 
     random_seed(args.seed, args.rank)
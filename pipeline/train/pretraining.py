@@ -21,6 +21,7 @@ from transformers import (
 import wandb
 from flamingo.modeling_flamingo import FlamingoForConditionalGeneration
 from otter.modeling_otter import OtterForConditionalGeneration
+from pipeline.mimicit_utils.mimicit_dataset import chunk_prompt_mask
 from pipeline.train.data import get_data
 from pipeline.train.distributed import world_info_from_env
 from pipeline.train.train_utils import AverageMeter, get_checkpoint
@@ -263,20 +264,8 @@ def train_one_epoch(args, model, epoch, mmc4_loader, laion_loader, tokenizer, op
         labels[labels == tokenizer.pad_token_id] = -100
         labels[:, 0] = -100
 
-        for i in range(labels.shape[0]):
-            # remove loss for any token before the first <image> token
-            label_idx = 0
-            while label_idx < labels.shape[1] and labels[i][label_idx] != media_token_id:
-                labels[i][label_idx] = -100
-                label_idx += 1
-
-            # get index of all endofchunk tokens in the sequence
-            endofchunk_idxs = torch.where(labels[i] == endofchunk_token_id)[0]
-            for endofchunk_idx in endofchunk_idxs:
-                token_idx = endofchunk_idx + 1
-                while token_idx < labels.shape[1] and labels[i][token_idx] != media_token_id:
-                    labels[i][token_idx] = -100
-                    token_idx += 1
+        # remove loss for any token before the first <image>, and for any token between <|endofchunk|> and the next <image>
+        labels[chunk_prompt_mask(labels == media_token_id, labels == endofchunk_token_id)] = -100
 
         labels[labels == media_token_id] = -100
         labels.to(device_id)
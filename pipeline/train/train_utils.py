@@ -1,7 +1,10 @@
+import threading
 import time
 from contextlib import suppress
+from queue import Empty, Full, Queue
 
 import torch
+from accelerate.utils import recursively_apply, send_to_device
 from tqdm import tqdm
 from torch.utils.data.distributed import DistributedSampler
 
@@ -217,6 +220,11 @@ def train_one_epoch(
             )
 
 
+def unwrap_compiled_model(model):
+    """Returns the module wrapped by torch.compile, or the model itself when it was not compiled"""
+    return getattr(model, "_orig_mod", model)
+
+
 def get_checkpoint(model):
     state_dict = model.state_dict()
 
@@ -246,6 +254,114 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class AsyncScalar(object):
+    """Copies a device scalar into pinned host memory without blocking, the value is only waited on when it is read"""
+
+    def __init__(self):
+        self.value = torch.zeros((), pin_memory=torch.cuda.is_available())
+        self.event = None
+
+    def copy_(self, tensor):
+        self.value.copy_(tensor.detach(), non_blocking=True)
+        if tensor.is_cuda:
+            self.event = torch.cuda.Event()
+            self.event.record()
+        return self
+
+    def item(self):
+        if self.event is not None:
+            self.event.synchronize()
+        return self.value.item()
+
+
+class MultiPrefetcher(object):
+    """Iterates several dataloaders in lockstep like zip(), a background thread fetches the following batches and uploads
+    them to the device on a side CUDA stream while the current step runs"""
+
+    def __init__(self, loaders, device, num_prefetch=2):
+        self.loaders = loaders
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+
+    def _upload(self, batches, stream):
+        with torch.cuda.stream(stream):
+            batches = send_to_device(batches, self.device, non_blocking=True)
+        if stream is None:
+            return batches, None
+        event = torch.cuda.Event()
+        event.record(stream)
+        return batches, event
+
+    @staticmethod
+    def _put(queue, item, stop):
+        # puts with a timeout so that the thread notices when the consumer has gone away instead of blocking forever
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _prefetch(self, iterators, first_batches, device_index, queue, stop):
+        # everything runs inside the try so that the consumer always receives the error or the end sentinel
+        try:
+            stream = None
+            if device_index is not None:
+                torch.cuda.set_device(device_index)
+                stream = torch.cuda.Stream(device=device_index)
+            if not self._put(queue, self._upload(first_batches, stream), stop):
+                return
+            for batches in zip(*iterators):
+                if not self._put(queue, self._upload(batches, stream), stop):
+                    return
+        except Exception as e:
+            self._put(queue, e, stop)
+        finally:
+            self._put(queue, None, stop)
+
+    def __iter__(self):
+        # the device index is resolved on the calling thread, a bare "cuda" device means the current device of that thread
+        device_index = None
+        if self.device.type == "cuda":
+            device_index = self.device.index if self.device.index is not None else torch.cuda.current_device()
+        iterators = [iter(loader) for loader in self.loaders]
+        # the loaders are expected to be plain dataloaders, accelerate-prepared ones synchronize their rng states with
+        # collectives and update the shared gradient state while iterating, neither of which may happen off the main thread.
+        # the first batches are still pulled here so that an empty loader simply ends the iteration
+        try:
+            first_batches = tuple([next(iterator) for iterator in iterators])
+        except StopIteration:
+            return
+        queue = Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        threading.Thread(target=self._prefetch, args=(iterators, first_batches, device_index, queue, stop), daemon=True).start()
+
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                batches, event = item
+                if event is not None:
+                    # the compute stream waits on the upload without blocking the host, and the batches are kept alive for it
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    recursively_apply(lambda tensor: tensor.record_stream(current_stream), batches)
+                yield batches
+        finally:
+            # when the consumer stops early (an exception in the step, or the generator being closed) the thread is told to
+            # exit and the batches it already uploaded are dropped, releasing their device memory
+            stop.set()
+            while True:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    break
+
+
 class DistributedProxySampler(DistributedSampler):
     """Sampler that restricts data loading to a subset of input sampler indices.
 
@@ -0,0 +1,148 @@
+import unittest
+
+import torch
+
+from pipeline.mimicit_utils.mimicit_dataset import chunk_prompt_mask, collate_labels
+
+PAD, MEDIA, ENDOFCHUNK, ANSWER = 0, 1, 2, 3
+
+
+def pad_rows(rows):
+    width = max(len(row) for row in rows)
+    return torch.tensor([row + [PAD] * (width - len(row)) for row in rows])
+
+
+def reference_labels(src_tokens, pad_idx, media_idx, endofchunk_idx, answer_idx):
+    # the per-row loop that used to build the labels in train_one_epoch
+    labels = src_tokens.clone()
+    labels[labels == pad_idx] = -100
+    labels[:, 0] = -100
+    for i in range(labels.shape[0]):
+        endofchunk_idxs = torch.where(labels[i] == endofchunk_idx)[0]
+        token_idx = 0
+        while token_idx < labels.shape[1] and labels[i][token_idx] != answer_idx:
+            labels[i][token_idx] = -100
+            token_idx += 1
+        for endofchunk_pos in endofchunk_idxs:
+            token_idx = endofchunk_pos + 1
+            while token_idx < labels.shape[1] and labels[i][token_idx] != answer_idx:
+                if labels[i][token_idx] != media_idx:
+                    labels[i][token_idx] = -100
+                token_idx += 1
+    labels[labels == answer_idx] = -100
+    labels[labels == media_idx] = -100
+    return labels
+
+
+def reference_mmc4_labels(src_tokens, pad_idx, media_idx, endofchunk_idx):
+    # the per-row loop that used to build the MMC4 labels in pretraining.py
+    labels = src_tokens.clone()
+    labels[labels == pad_idx] = -100
+    labels[:, 0] = -100
+    for i in range(labels.shape[0]):
+        label_idx = 0
+        while label_idx < labels.shape[1] and labels[i][label_idx] != media_idx:
+            labels[i][label_idx] = -100
+            label_idx += 1
+        endofchunk_idxs = torch.where(labels[i] == endofchunk_idx)[0]
+        for endofchunk_pos in endofchunk_idxs:
+            token_idx = endofchunk_pos + 1
+            while token_idx < labels.shape[1] and labels[i][token_idx] != media_idx:
+                labels[i][token_idx] = -100
+                token_idx += 1
+    labels[labels == media_idx] = -100
+    return labels
+
+
+def mmc4_labels(src_tokens, pad_idx, media_idx, endofchunk_idx):
+    # the same steps as the MMC4 forward pass in pretraining.py
+    labels = src_tokens.clone()
+    labels[labels == pad_idx] = -100
+    labels[:, 0] = -100
+    labels[chunk_prompt_mask(labels == media_idx, labels == endofchunk_idx)] = -100
+    labels[labels == media_idx] = -100
+    return labels
+
+
+class TestCollateLabels(unittest.TestCase):
+    def assert_matches_reference(self, rows):
+        src_tokens = pad_rows(rows)
+        labels = collate_labels(src_tokens, PAD, MEDIA, ENDOFCHUNK, ANSWER)
+        self.assertTrue(torch.equal(labels, reference_labels(src_tokens, PAD, MEDIA, ENDOFCHUNK, ANSWER)))
+        return labels
+
+    def test_single_chunk_with_padding(self):
+        labels = self.assert_matches_reference(
+            [
+                [MEDIA, 10, 11, ANSWER, 20, 21, ENDOFCHUNK],
+                [MEDIA, 10, ANSWER, 20, ENDOFCHUNK],
+            ]
+        )
+        self.assertEqual(labels[0].tolist(), [-100, -100, -100, -100, 20, 21, ENDOFCHUNK])
+        self.assertEqual(labels[1].tolist(), [-100, -100, -100, 20, ENDOFCHUNK, -100, -100])
+
+    def test_first_token_is_a_sentinel(self):
+        self.assert_matches_reference(
+            [
+                [ANSWER, 10, 11, ANSWER, 20, ENDOFCHUNK],
+                [ENDOFCHUNK, 10, ANSWER, 20, ENDOFCHUNK, 12],
+                [ANSWER, 20, 21, ENDOFCHUNK, 12, ANSWER, 22],
+            ]
+        )
+
+    def test_media_between_chunks(self):
+        self.assert_matches_reference(
+            [
+                [MEDIA, 10, ANSWER, 20, ENDOFCHUNK, MEDIA, 11, MEDIA, ANSWER, 21, ENDOFCHUNK],
+                [MEDIA, 10, ANSWER, 20, ENDOFCHUNK, 11, MEDIA, 12],
+            ]
+        )
+
+    def test_several_chunks(self):
+        self.assert_matches_reference(
+            [
+                [MEDIA, 10, ANSWER, 20, ENDOFCHUNK, 11, ANSWER, 21, ENDOFCHUNK, 12, ANSWER, 22, 23, ENDOFCHUNK],
+                [MEDIA, 10, ANSWER, 20, ENDOFCHUNK, ENDOFCHUNK, 11, ANSWER, ANSWER, 21, ENDOFCHUNK],
+                [MEDIA, 10, 11, 12],
+            ]
+        )
+
+
+class TestMMC4Labels(unittest.TestCase):
+    def assert_matches_reference(self, rows):
+        src_tokens = pad_rows(rows)
+        labels = mmc4_labels(src_tokens, PAD, MEDIA, ENDOFCHUNK)
+        self.assertTrue(torch.equal(labels, reference_mmc4_labels(src_tokens, PAD, MEDIA, ENDOFCHUNK)))
+        return labels
+
+    def test_single_chunk_with_padding(self):
+        labels = self.assert_matches_reference(
+            [
+                [10, 11, MEDIA, 20, 21, ENDOFCHUNK],
+                [10, MEDIA, 20, ENDOFCHUNK],
+            ]
+        )
+        self.assertEqual(labels[0].tolist(), [-100, -100, -100, 20, 21, ENDOFCHUNK])
+        self.assertEqual(labels[1].tolist(), [-100, -100, 20, ENDOFCHUNK, -100, -100])
+
+    def test_first_token_is_a_sentinel(self):
+        self.assert_matches_reference(
+            [
+                [MEDIA, 10, 11, MEDIA, 20, ENDOFCHUNK],
+                [ENDOFCHUNK, 10, MEDIA, 20, ENDOFCHUNK, 12],
+                [MEDIA, 20, 21, ENDOFCHUNK, 12, MEDIA, 22],
+            ]
+        )
+
+    def test_several_chunks(self):
+        self.assert_matches_reference(
+            [
+                [MEDIA, 20, ENDOFCHUNK, 11, 12, MEDIA, 21, ENDOFCHUNK, MEDIA, 22, 23, ENDOFCHUNK, 13],
+                [10, MEDIA, 20, ENDOFCHUNK, ENDOFCHUNK, 11, MEDIA, MEDIA, 21, ENDOFCHUNK],
+                [10, 11, 12, 13],
+            ]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+import torch
+from torch.utils.data import DataLoader
+
+from pipeline.train.train_utils import MultiPrefetcher, get_checkpoint, unwrap_compiled_model
+
+
+class TestUnwrapCompiledModel(unittest.TestCase):
+    def test_checkpoint_keys_of_compiled_model(self):
+        model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.LayerNorm(4))
+        model[1].weight.requires_grad_(False)
+        compiled_model = torch.compile(model, dynamic=True)
+
+        checkpoint = get_checkpoint(unwrap_compiled_model(compiled_model))
+        self.assertEqual(set(checkpoint), set(model.state_dict()) - {"1.weight"})
+        missing_keys, unexpected_keys = model.load_state_dict(checkpoint, False)
+        self.assertEqual(missing_keys, ["1.weight"])
+        self.assertEqual(unexpected_keys, [])
+
+    def test_uncompiled_model_is_returned_as_is(self):
+        model = torch.nn.Linear(4, 4)
+        self.assertIs(unwrap_compiled_model(model), model)
+
+
+class TestMultiPrefetcher(unittest.TestCase):
+    def wait_for_threads(self, count, timeout=5.0):
+        deadline = time.time() + timeout
+        while threading.active_count() > count and time.time() < deadline:
+            time.sleep(0.05)
+        return threading.active_count()
+
+    def test_iterates_loaders_in_lockstep(self):
+        loaders = [DataLoader(list(range(10)), batch_size=3), DataLoader(list(range(100, 120)), batch_size=3)]
+        batches = list(MultiPrefetcher(loaders, "cpu"))
+        expected = list(zip(*loaders))
+        self.assertEqual(len(batches), len(expected))
+        for got, ref in zip(batches, expected):
+            self.assertTrue(all(torch.equal(g, r) for g, r in zip(got, ref)))
+
+    def test_worker_error_is_raised(self):
+        def failing_batches():
+            yield torch.zeros(1)
+            raise RuntimeError("loader failed")
+
+        class FailingLoader(object):
+            def __iter__(self):
+                return failing_batches()
+
+        with self.assertRaisesRegex(RuntimeError, "loader failed"):
+            list(MultiPrefetcher([FailingLoader()], "cpu"))
+
+    def test_thread_exits_when_consumer_stops_early(self):
+        num_threads = threading.active_count()
+        batches = iter(MultiPrefetcher([DataLoader(list(range(100)), batch_size=1)], "cpu", num_prefetch=1))
+        next(batches)
+        batches.close()
+        self.assertEqual(self.wait_for_threads(num_threads), num_threads)
+
+
+if __name__ == "__main__":
+    unittest.main()